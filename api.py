@@ -3,26 +3,36 @@
 #
 # Endpoints:
 #   POST /event/{client_slug}/order   — receive a new order
+#   POST /event/{client_slug}/orders  — receive a batch of orders
 #   POST /event/{client_slug}/generic — receive any other event
 #   GET  /maintenance/{client_slug}   — check maintenance status
 #   GET  /health                      — uptime check
 #
 #   POST /chat/{client_slug}/start    — widget opens, creates a session
 #   POST /chat/{client_slug}/message  — visitor sends a message
-#   GET  /chat/{session_id}/poll      — widget polls for owner replies
+#   GET  /chat/{session_id}/poll      — widget long-polls for owner replies
 #   POST /chat/{session_id}/close     — widget closes the session
 
 import hmac
 import time
+import orjson
 import asyncio
+import hashlib
+import logging
+from cachetools import TTLCache
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Header, Path
+from fastapi import FastAPI, HTTPException, Header, Path, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+from typing import Any, Optional
 
 import database as db
-from notifier import send_order_notification, send_event_notification, send_chat_notification, send_chat_followup_notification
+from config import CHAT_POLL_TIMEOUT, API_MAX_IN_FLIGHT, SLUG_PATTERN
+from notifier import send_order_notification, queue_order_notification, send_event_notification, is_notifiable_event, send_chat_notification, send_chat_followup_notification, run_order_batcher, start_send_workers, stop_send_workers, close_bot
+
+log = logging.getLogger("relay.api")
 
 
 # ======================
@@ -31,11 +41,27 @@ from notifier import send_order_notification, send_event_notification, send_chat
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await asyncio.to_thread(db.init_db)
+    await asyncio.to_thread(db.init_pool)
+    app.state.bg_tasks = set()
+    start_send_workers()
+    listener = asyncio.create_task(listen_for_chat())
+    batcher  = asyncio.create_task(run_order_batcher())
+    ticker   = asyncio.create_task(refresh_health())
     print("✅ Relay API starting")
     yield
     print("Relay API shutting down")
-
-app = FastAPI(title="Relay API", lifespan=lifespan)
+    listener.cancel()
+    ticker.cancel()
+    # Let in-flight notifications finish before the pool goes away
+    await asyncio.gather(*app.state.bg_tasks, return_exceptions=True)
+    batcher.cancel()
+    await asyncio.gather(batcher, return_exceptions=True)
+    await stop_send_workers()
+    await close_bot()
+    db.close_pool()
+
+app = FastAPI(title="Relay API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow your website to call the API
 app.add_middleware(
@@ -45,21 +71,95 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization"],
 )
 
+# Chat polls grow with the conversation — compress anything non-trivial
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=4)
+
+
+# ======================
+# LOAD SHEDDING
+# ======================
+
+# Beyond API_MAX_IN_FLIGHT concurrent requests, answer 503 right away instead
+# of queueing work inside the event loop. Long polls and /health are exempt —
+# polls are mostly idle waits and would otherwise starve real traffic. This is
+# the only concurrency cap: uvicorn's --limit-concurrency would count held polls.
+_request_slots = asyncio.Semaphore(API_MAX_IN_FLIGHT)
+_in_flight     = 0
+
+class LimitInFlight:
+    """Plain ASGI middleware — unlike @app.middleware("http") it doesn't wrap every response body."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if path == "/health" or path.endswith("/poll"):
+            return await self.app(scope, receive, send)
+        if _request_slots.locked():
+            busy = ORJSONResponse({"detail": "Server busy"}, status_code=503, headers={"Retry-After": "1"})
+            return await busy(scope, receive, send)
+        async with _request_slots:
+            _in_flight += 1
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _in_flight -= 1
+
+# Added last so it runs first, before CORS and GZip do any work
+app.add_middleware(LimitInFlight)
+
+
+# ======================
+# BACKGROUND WORK
+# ======================
+
+# Caps concurrent Telegram sends so a slow API can't pile up unbounded work
+_bg_slots = asyncio.Semaphore(128)
+
+async def _guarded(coro):
+    async with _bg_slots:
+        try:
+            await coro
+        except Exception:
+            log.exception("Background notification failed")
+
+def spawn_bg(coro):
+    """Run a notification after the response is sent, keeping a reference until it finishes."""
+    task = asyncio.create_task(_guarded(coro))
+    app.state.bg_tasks.add(task)
+    task.add_done_callback(app.state.bg_tasks.discard)
+
+def notify_order(client: dict, order):
+    """Hand an order to the batcher without awaiting; only a full queue costs a task."""
+    if not queue_order_notification(client, order):
+        spawn_bg(send_order_notification(client, order))
+
 
 # ======================
 # REQUEST MODELS
 # ======================
 
+# Anything else 422s before touching the cache or the database
+SESSION_ID_PATTERN = r"^[A-Z0-9]{8,32}$"
+
 class OrderEvent(BaseModel):
     order_number:   str
     customer_name:  Optional[str] = "Unknown"
     total:          float
     item_count:     Optional[int] = 1
-    received_at:    Optional[int] = None
+    # Unix seconds — bounded so a millisecond timestamp 422s instead of breaking formatting
+    received_at:    Optional[int] = Field(default=None, ge=0, lt=2**32)
+
+class OrderBatch(BaseModel):
+    orders: list[OrderEvent] = Field(min_length=1, max_length=500)
 
 class GenericEvent(BaseModel):
     event_type: str
-    payload:    Optional[dict] = {}
+    payload:    Optional[dict[str, Any]] = {}
 
 class ChatStart(BaseModel):
     visitor_name: Optional[str] = "Visitor"
@@ -67,42 +167,104 @@ class ChatStart(BaseModel):
     first_message: str           # first message sent with the session
 
 class ChatMessage(BaseModel):
-    session_id: str
+    session_id: str = Field(pattern=SESSION_ID_PATTERN)
     message:    str
 
 
+# ======================
+# STATIC RESPONSES
+# ======================
+
+# Serialized once at import — these bodies never change
+_OK_BYTES    = orjson.dumps({"ok": True})
+_health_body = b""
+
+def ok_response() -> Response:
+    return Response(_OK_BYTES, media_type="application/json")
+
+def _build_health():
+    global _health_body
+    _health_body = orjson.dumps({
+        "status":    "ok",
+        "service":   "relay",
+        "time":      int(time.time()),
+        "in_flight": _in_flight,
+        "db_in_use": db.pool_in_use(),
+    })
+
+async def refresh_health():
+    """Rebuild the /health body once a second so the endpoint only returns bytes."""
+    while True:
+        _build_health()
+        await asyncio.sleep(1)
+
+_build_health()
+
+
 # ======================
 # AUTH
 # ======================
 
 def verify_secret(client: dict, authorization: str):
-    if not authorization or not authorization.startswith("Bearer "):
+    expected = client["api_secret_b"]
+    if not authorization.startswith("Bearer "):
+        # Same constant-time work as a real check, so a missing header isn't faster
+        hmac.compare_digest(b"\x00" * len(expected), expected)
         raise HTTPException(status_code=401, detail="Missing Authorization header")
-    incoming = authorization.removeprefix("Bearer ").strip()
-    if not hmac.compare_digest(incoming, client["api_secret"]):
+    incoming = authorization[7:].strip().encode()
+    if not hmac.compare_digest(incoming, expected):
         raise HTTPException(status_code=401, detail="Invalid secret")
 
 
+# ======================
+# CLIENT LOOKUP
+# ======================
+
+# One in-flight DB lookup per slug, so a cold cache under a burst
+# doesn't send every request to PostgreSQL at once.
+_client_locks: dict[str, asyncio.Lock] = {}
+
+async def get_client_cached(slug: str) -> Optional[dict]:
+    client = db.get_cached_client(slug)
+    if client is not None:
+        return client
+    lock = _client_locks.setdefault(slug, asyncio.Lock())
+    try:
+        async with lock:
+            return await asyncio.to_thread(db.get_client_by_slug_cached, slug)
+    finally:
+        if not lock.locked():
+            _client_locks.pop(slug, None)
+
+
+async def authed_client(
+    client_slug:   str = Path(..., pattern=SLUG_PATTERN),
+    authorization: str = Header(default=""),
+) -> dict:
+    """Dependency for client endpoints: resolve the slug, 404 if unknown, check the secret."""
+    client = await get_client_cached(client_slug)
+    if not client:
+        raise HTTPException(status_code=404, detail="Client not found")
+    verify_secret(client, authorization)
+    return client
+
+
 # ======================
 # EXISTING ENDPOINTS
 # ======================
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "service": "relay", "time": int(time.time())}
+    return Response(_health_body, media_type="application/json")
 
 
 @app.post("/event/{client_slug}/order")
 async def receive_order(
-    client_slug:    str = Path(...),
-    body:           OrderEvent = ...,
-    authorization:  str = Header(default=""),
+    body:   OrderEvent = ...,
+    client: dict = Depends(authed_client),
 ):
-    client = db.get_client_by_slug(client_slug)
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    verify_secret(client, authorization)
-    db.record_order(
+    await asyncio.to_thread(
+        db.record_order,
         client_id=client["id"],
         order_number=body.order_number,
         customer_name=body.customer_name,
@@ -110,35 +272,49 @@ async def receive_order(
         item_count=body.item_count,
         received_at=body.received_at,
     )
-    asyncio.create_task(send_order_notification(client, body.dict()))
-    return {"ok": True}
+    notify_order(client, body)
+    return ok_response()
+
+
+@app.post("/event/{client_slug}/orders")
+async def receive_order_batch(
+    body:   OrderBatch = ...,
+    client: dict = Depends(authed_client),
+):
+    # Stores that queue up orders can flush them in one request — one INSERT, one commit
+    await asyncio.to_thread(
+        db.record_orders_bulk,
+        client["id"],
+        [o.model_dump() for o in body.orders],
+    )
+    for order in body.orders:
+        notify_order(client, order)
+    return ok_response()
 
 
 @app.post("/event/{client_slug}/generic")
 async def receive_generic_event(
-    client_slug:    str = Path(...),
-    body:           GenericEvent = ...,
-    authorization:  str = Header(default=""),
+    body:   GenericEvent = ...,
+    client: dict = Depends(authed_client),
 ):
-    client = db.get_client_by_slug(client_slug)
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    verify_secret(client, authorization)
-    db.log_event(client["id"], body.event_type, body.payload)
-    asyncio.create_task(send_event_notification(client, body.event_type, body.payload))
-    return {"ok": True}
+    await asyncio.to_thread(db.log_event, client["id"], body.event_type, body.payload)
+    # Unknown types are only logged — don't schedule a task that would format nothing
+    if client.get("telegram_chat_id") and is_notifiable_event(body.event_type):
+        spawn_bg(send_event_notification(client, body.event_type, body.payload))
+    return ok_response()
 
 
 @app.get("/maintenance/{client_slug}")
 async def get_maintenance(
-    client_slug:   str = Path(...),
-    authorization: str = Header(default=""),
+    response:      Response,
+    client:        dict = Depends(authed_client),
+    if_none_match: str = Header(default=""),
 ):
-    client = db.get_client_by_slug(client_slug)
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    verify_secret(client, authorization)
-    status = db.get_setting(client["id"], "maintenance") or "off"
+    status = await asyncio.to_thread(db.get_setting_cached, client["id"], "maintenance") or "off"
+    etag   = '"' + hashlib.blake2b(status.encode(), digest_size=8).hexdigest() + '"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return {"maintenance": status}
 
 
@@ -148,68 +324,84 @@ async def get_maintenance(
 
 @app.post("/chat/{client_slug}/start")
 async def chat_start(
-    client_slug:   str = Path(...),
-    body:          ChatStart = ...,
-    authorization: str = Header(default=""),
+    body:   ChatStart = ...,
+    client: dict = Depends(authed_client),
 ):
     """Widget calls this when user sends their first message. Returns session_id."""
-    client = db.get_client_by_slug(client_slug)
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    verify_secret(client, authorization)
-
-    session_id = db.create_chat_session(
+    session_id = await asyncio.to_thread(
+        db.create_chat_session,
         client_id=client["id"],
         visitor_id=body.visitor_name,
         page=body.page,
     )
 
     # Save the first message
-    db.add_chat_message(session_id, "visitor", body.first_message)
+    await asyncio.to_thread(db.add_chat_message, session_id, "visitor", body.first_message)
 
     # Notify owner on Telegram
-    asyncio.create_task(send_chat_notification(client, session_id, body.visitor_name, body.page, body.first_message))
+    spawn_bg(send_chat_notification(client, session_id, body.visitor_name, body.page, body.first_message))
 
     return {"ok": True, "session_id": session_id}
 
 
 @app.post("/chat/{client_slug}/message")
 async def chat_message(
-    client_slug:   str = Path(...),
-    body:          ChatMessage = ...,
-    authorization: str = Header(default=""),
+    body:   ChatMessage = ...,
+    client: dict = Depends(authed_client),
 ):
     """Widget sends follow-up messages."""
-    client = db.get_client_by_slug(client_slug)
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
-    verify_secret(client, authorization)
-
-    session = db.get_chat_session(body.session_id)
+    session = await asyncio.to_thread(db.get_chat_session, body.session_id)
     if not session or session["client_id"] != client["id"]:
         raise HTTPException(status_code=404, detail="Session not found")
     if session["status"] == "closed":
         raise HTTPException(status_code=400, detail="Session is closed")
 
-    db.add_chat_message(body.session_id, "visitor", body.message)
+    await asyncio.to_thread(db.add_chat_message, body.session_id, "visitor", body.message)
 
     # Also notify owner for follow-up messages
-    asyncio.create_task(send_chat_followup(client, session, body.message))
+    spawn_bg(send_chat_followup(client, session, body.message))
 
-    return {"ok": True}
+    return ok_response()
 
 
 @app.get("/chat/{session_id}/poll")
 async def chat_poll(
-    session_id: str = Path(...),
+    session_id: str = Path(..., pattern=SESSION_ID_PATTERN),
     since:      int = 0,
 ):
-    """Widget polls this every 3 seconds to get owner replies. No auth — session_id is the secret."""
-    session = db.get_chat_session(session_id)
+    """
+    Widget long-polls this for owner replies. No auth — session_id is the secret.
+    Returns as soon as there are messages after `since`, or empty after CHAT_POLL_TIMEOUT.
+    """
+    session = await get_session_cached(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    messages = db.get_chat_messages(session_id, since=since)
+    # Register before querying so a write landing in between still wakes us.
+    # Each poller (e.g. a second tab) gets its own event.
+    wake = asyncio.Event()
+    _chat_waiters.setdefault(session_id, set()).add(wake)
+    try:
+        latest = _chat_latest.get(session_id)
+        if latest is not None and latest <= since:
+            messages = []   # nothing newer has been announced — skip the query
+        else:
+            messages = await asyncio.to_thread(db.get_chat_messages, session_id, since)
+        if not messages and session["status"] != "closed":
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=CHAT_POLL_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                session  = await get_session_cached(session_id)
+                messages = await asyncio.to_thread(db.get_chat_messages, session_id, since)
+    finally:
+        waiters = _chat_waiters.get(session_id)
+        if waiters is not None:
+            waiters.discard(wake)
+            if not waiters:
+                del _chat_waiters[session_id]
+
     return {
         "status": session["status"],
         "messages": messages,
@@ -217,13 +409,83 @@ async def chat_poll(
 
 
 @app.post("/chat/{session_id}/close")
-async def chat_close(session_id: str = Path(...)):
+async def chat_close(session_id: str = Path(..., pattern=SESSION_ID_PATTERN)):
     """Widget calls this when user closes the chat."""
-    session = db.get_chat_session(session_id)
+    session = await asyncio.to_thread(db.get_chat_session, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    db.close_chat_session(session_id)
-    return {"ok": True}
+    await asyncio.to_thread(db.close_chat_session, session_id)
+    return ok_response()
+
+
+# ======================
+# CHAT WAKE-UPS
+# ======================
+
+# session_id -> one event per waiting poller, set when that session gets a
+# new message or is closed
+_chat_waiters: dict[str, set[asyncio.Event]] = {}
+# session_id -> newest message id announced while the listener was connected
+_chat_latest   = TTLCache(maxsize=10000, ttl=3600)
+# Short-lived session rows for polling; evicted when a close is announced
+_session_cache = TTLCache(maxsize=10000, ttl=5)
+
+async def get_session_cached(session_id: str) -> Optional[dict]:
+    session = _session_cache.get(session_id)
+    if session is None:
+        session = await asyncio.to_thread(db.get_chat_session, session_id)
+        if session:
+            _session_cache[session_id] = session
+    return session
+
+def _on_chat_notify(payload: str):
+    session_id, _, tag = payload.partition(":")
+    if tag == "closed":
+        _session_cache.pop(session_id, None)
+    else:
+        _chat_latest[session_id] = max(int(tag), _chat_latest.get(session_id, 0))
+    for event in _chat_waiters.pop(session_id, ()):
+        event.set()
+
+async def listen_for_chat():
+    """
+    Wake long-polling widgets on NOTIFY from either the API or the bot process.
+    The same connection carries setting changes, so /maintenance caches follow
+    a toggle made in the bot right away instead of after the TTL.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            conn = await asyncio.to_thread(db.listen, db.CHAT_CHANNEL, db.SETTINGS_CHANNEL)
+        except Exception as e:
+            log.warning(f"Chat listener failed to connect: {e}")
+            await asyncio.sleep(5)
+            continue
+
+        fd    = conn.fileno()
+        ready = asyncio.Event()
+        loop.add_reader(fd, ready.set)
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel == db.SETTINGS_CHANNEL:
+                        db.evict_setting(notify.payload)
+                    else:
+                        _on_chat_notify(notify.payload)
+        except Exception as e:
+            log.warning(f"Chat listener lost connection: {e}")
+        finally:
+            loop.remove_reader(fd)
+            conn.close()
+            # Announcements may have been missed while disconnected
+            _chat_latest.clear()
+            _session_cache.clear()
+            db.clear_setting_cache()
+        await asyncio.sleep(1)
 
 
 # ======================
@@ -12,9 +12,12 @@
 #   /chats              — list open chat sessions
 #   /help               — command list
 
+import re
 import asyncio
 import logging
-from datetime import datetime
+from hmac import compare_digest
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -34,8 +37,11 @@ from notifier import (
     format_recent_orders,
     send_event_notification,
     send_chat_followup_notification,
+    set_bot,
+    start_send_workers,
+    stop_send_workers,
 )
-from config import BOT_TOKEN, SUMMARY_HOUR, SUMMARY_MINUTE, TELEGRAM_GROUP_ID
+from config import SLUG_PATTERN, BOT_TOKEN, SUMMARY_HOUR, SUMMARY_MINUTE, TELEGRAM_GROUP_ID, TIMEZONE, TELEGRAM_POOL_SIZE
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -43,6 +49,46 @@ logging.basicConfig(
 )
 log = logging.getLogger("relay.bot")
 
+_SLUG_RE = re.compile(SLUG_PATTERN)
+
+
+# ======================
+# MESSAGE TEMPLATES
+# ======================
+
+_WELCOME_TEXT = (
+    "Welcome to Relay!\n\n"
+    "To link this chat to your store, run:\n"
+    "`/start your-store-slug your-api-secret`"
+)
+
+_MAINTENANCE_STATUS = (
+    "{icon} *Maintenance is {label}*\n\n"
+    "To change: `/maintenance on` or `/maintenance off`"
+)
+
+_HELP_TEMPLATE = (
+    "*Relay — {name}*\n"
+    "\n"
+    "*Orders & Stats*\n"
+    "/today — today's orders and revenue\n"
+    "/week — last 7 days\n"
+    "/month — last 30 days\n"
+    "/orders — 5 most recent orders\n"
+    "\n"
+    "*Store Control*\n"
+    "/maintenance — check or toggle maintenance mode\n"
+    "\n"
+    "*Website Chat*\n"
+    "/chats — list open chat sessions\n"
+    "/reply <id> <msg> — reply to a visitor\n"
+    "/close <id> — close a chat session\n"
+    "\n"
+    "/help — this message\n"
+    "\n"
+    "_You get automatic notifications when orders and chats come in._"
+)
+
 
 # ======================
 # HELPERS
@@ -50,16 +96,30 @@ log = logging.getLogger("relay.bot")
 
 async def get_client_for_chat(update: Update) -> dict | None:
     chat_id = update.effective_chat.id
-    client  = db.get_client_by_chat_id(chat_id)
+    client  = await asyncio.to_thread(db.get_client_by_chat_id, chat_id)
     if not client:
-        await update.message.reply_text(
-            "This chat isn't linked to any store yet.\n"
-            "Use /start <store-slug> <api-secret> to link it."
-        )
+        await reply_not_linked(update)
         return None
     return client
 
 
+async def reply_not_linked(update: Update):
+    await update.message.reply_text(
+        "This chat isn't linked to any store yet.\n"
+        "Use /start <store-slug> <api-secret> to link it."
+    )
+
+
+async def reply_stats(update: Update, lookup, formatter):
+    """Resolve the chat's client and its stats in one DB call, then reply."""
+    found = await asyncio.to_thread(lookup, update.effective_chat.id)
+    if not found:
+        await reply_not_linked(update)
+        return
+    client, stats = found
+    await update.message.reply_text(formatter(client, stats), parse_mode="Markdown")
+
+
 # ======================
 # EXISTING COMMANDS
 # ======================
@@ -67,7 +127,7 @@ async def get_client_for_chat(update: Update) -> dict | None:
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if not args:
-        client = db.get_client_by_chat_id(update.effective_chat.id)
+        client = await asyncio.to_thread(db.get_client_by_chat_id, update.effective_chat.id)
         if client:
             await update.message.reply_text(
                 f"✅ This chat is linked to *{client['name']}*\n"
@@ -75,12 +135,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown",
             )
         else:
-            await update.message.reply_text(
-                "Welcome to Relay!\n\n"
-                "To link this chat to your store, run:\n"
-                "`/start your-store-slug your-api-secret`",
-                parse_mode="Markdown",
-            )
+            await update.message.reply_text(_WELCOME_TEXT, parse_mode="Markdown")
         return
 
     if len(args) < 2:
@@ -93,23 +148,30 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     slug   = args[0].lower().strip()
     secret = args[1].strip()
 
-    client = db.get_client_by_slug(slug)
+    if not _SLUG_RE.match(slug):
+        await update.message.reply_text(
+            "That doesn't look like a store slug — use lowercase letters, digits and hyphens."
+        )
+        return
+
+    client = await asyncio.to_thread(db.get_client_by_slug_cached, slug)
     if not client:
         await update.message.reply_text(f"No store found with slug `{slug}`.", parse_mode="Markdown")
         return
 
-    import hmac
-    if not hmac.compare_digest(secret, client["api_secret"]):
+    if not compare_digest(secret, client["api_secret"]):
         await update.message.reply_text("Wrong secret. Check your credentials.")
         return
 
     chat = update.effective_chat
-    db.set_client_chat(
+    await asyncio.to_thread(
+        db.set_client_chat,
         client_id = client["id"],
         chat_id   = chat.id,
         chat_type = chat.type,
         label     = chat.title or chat.username or "owner chat",
     )
+    db.invalidate_client(slug)
     await update.message.reply_text(
         f"✅ Linked! This chat will now receive Relay notifications for *{client['name']}*\n\n"
         f"Type /help to see what you can do.",
@@ -119,30 +181,21 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    client = await get_client_for_chat(update)
-    if not client: return
-    stats = db.get_today_stats(client["id"])
-    await update.message.reply_text(format_today(client, stats), parse_mode="Markdown")
+    await reply_stats(update, db.get_client_and_today_stats, format_today)
 
 
 async def cmd_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    client = await get_client_for_chat(update)
-    if not client: return
-    stats = db.get_week_stats(client["id"])
-    await update.message.reply_text(format_week(client, stats), parse_mode="Markdown")
+    await reply_stats(update, db.get_client_and_week_stats, format_week)
 
 
 async def cmd_month(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    client = await get_client_for_chat(update)
-    if not client: return
-    stats = db.get_month_stats(client["id"])
-    await update.message.reply_text(format_month(client, stats), parse_mode="Markdown")
+    await reply_stats(update, db.get_client_and_month_stats, format_month)
 
 
 async def cmd_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client = await get_client_for_chat(update)
     if not client: return
-    orders = db.get_recent_orders(client["id"], limit=5)
+    orders = await asyncio.to_thread(db.get_recent_orders, client["id"], 5)
     await update.message.reply_text(format_recent_orders(client, orders), parse_mode="Markdown")
 
 
@@ -151,12 +204,11 @@ async def cmd_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not client: return
     args = context.args
     if not args:
-        current = db.get_setting(client["id"], "maintenance") or "off"
+        current = await asyncio.to_thread(db.get_setting, client["id"], "maintenance") or "off"
         icon    = "🔧" if current == "on" else "✅"
         label   = "ON — store is offline" if current == "on" else "OFF — store is live"
         await update.message.reply_text(
-            f"{icon} *Maintenance is {label}*\n\n"
-            f"To change: `/maintenance on` or `/maintenance off`",
+            _MAINTENANCE_STATUS.format(icon=icon, label=label),
             parse_mode="Markdown",
         )
         return
@@ -164,7 +216,7 @@ async def cmd_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action not in ("on", "off"):
         await update.message.reply_text("Usage: `/maintenance on` or `/maintenance off`", parse_mode="Markdown")
         return
-    db.set_setting(client["id"], "maintenance", action)
+    await asyncio.to_thread(db.set_setting, client["id"], "maintenance", action)
     if action == "on":
         await update.message.reply_text("🔧 *Maintenance mode ON*\nStore is now showing maintenance page.", parse_mode="Markdown")
     else:
@@ -192,7 +244,7 @@ async def cmd_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session_id = args[0].upper()
     message    = " ".join(args[1:])
 
-    session = db.get_chat_session(session_id)
+    session = await asyncio.to_thread(db.get_chat_session, session_id)
     if not session:
         await update.message.reply_text(f"Session `{session_id}` not found.", parse_mode="Markdown")
         return
@@ -203,7 +255,7 @@ async def cmd_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Session `{session_id}` is already closed.", parse_mode="Markdown")
         return
 
-    db.add_chat_message(session_id, "owner", message)
+    await asyncio.to_thread(db.add_chat_message, session_id, "owner", message)
 
     visitor = session.get("visitor_id") or "Visitor"
     await update.message.reply_text(
@@ -224,7 +276,7 @@ async def cmd_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     session_id = args[0].upper()
-    session    = db.get_chat_session(session_id)
+    session    = await asyncio.to_thread(db.get_chat_session, session_id)
     if not session:
         await update.message.reply_text(f"Session `{session_id}` not found.", parse_mode="Markdown")
         return
@@ -232,7 +284,7 @@ async def cmd_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("That session doesn't belong to your store.")
         return
 
-    db.close_chat_session(session_id)
+    await asyncio.to_thread(db.close_chat_session, session_id)
     visitor = session.get("visitor_id") or "Visitor"
     await update.message.reply_text(
         f"🔒 Session `{session_id}` with *{visitor}* closed.",
@@ -246,7 +298,7 @@ async def cmd_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client = await get_client_for_chat(update)
     if not client: return
 
-    sessions = db.get_open_sessions_for_client(client["id"])
+    sessions = await asyncio.to_thread(db.get_open_sessions_for_client, client["id"])
     if not sessions:
         await update.message.reply_text("No open chat sessions right now.")
         return
@@ -278,11 +330,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("close:"):
         session_id = data.split(":")[1]
-        session    = db.get_chat_session(session_id)
+        session    = await asyncio.to_thread(db.get_chat_session, session_id)
         if not session:
             await query.message.reply_text("Session not found.")
             return
-        db.close_chat_session(session_id)
+        await asyncio.to_thread(db.close_chat_session, session_id)
         visitor = session.get("visitor_id") or "Visitor"
         # Update the original message to show it's closed
         try:
@@ -297,7 +349,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session_id = parts[1]
         visitor    = parts[2] if len(parts) > 2 else "Visitor"
 
-        session = db.get_chat_session(session_id)
+        session = await asyncio.to_thread(db.get_chat_session, session_id)
         if not session:
             await query.message.reply_text("Session not found.")
             return
@@ -333,13 +385,13 @@ async def handle_reply_message(update: Update, context: ContextTypes.DEFAULT_TYP
     if not message:
         return
 
-    session = db.get_chat_session(session_id)
+    session = await asyncio.to_thread(db.get_chat_session, session_id)
     if not session or session["status"] == "closed":
         await update.message.reply_text(f"Session `{session_id}` is closed.", parse_mode="Markdown")
         context.user_data.pop("awaiting_reply", None)
         return
 
-    db.add_chat_message(session_id, "owner", message)
+    await asyncio.to_thread(db.add_chat_message, session_id, "owner", message)
     context.user_data.pop("awaiting_reply", None)
 
     # Confirm + show Reply button again for convenience
@@ -360,28 +412,7 @@ async def handle_reply_message(update: Update, context: ContextTypes.DEFAULT_TYP
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     client     = await get_client_for_chat(update)
     store_name = client["name"] if client else "your store"
-    await update.message.reply_text(
-        f"*Relay — {store_name}*\n"
-        f"\n"
-        f"*Orders & Stats*\n"
-        f"/today — today's orders and revenue\n"
-        f"/week — last 7 days\n"
-        f"/month — last 30 days\n"
-        f"/orders — 5 most recent orders\n"
-        f"\n"
-        f"*Store Control*\n"
-        f"/maintenance — check or toggle maintenance mode\n"
-        f"\n"
-        f"*Website Chat*\n"
-        f"/chats — list open chat sessions\n"
-        f"/reply <id> <msg> — reply to a visitor\n"
-        f"/close <id> — close a chat session\n"
-        f"\n"
-        f"/help — this message\n"
-        f"\n"
-        f"_You get automatic notifications when orders and chats come in._",
-        parse_mode="Markdown",
-    )
+    await update.message.reply_text(_HELP_TEMPLATE.format(name=store_name), parse_mode="Markdown")
 
 
 # ======================
@@ -389,43 +420,66 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ======================
 
 async def daily_summary_job(context: ContextTypes.DEFAULT_TYPE):
-    now       = datetime.now()
-    today_key = str(now.date())
-
-    if context.bot_data.get("summary_last_day") != today_key:
-        context.bot_data["summary_sent"]     = set()
-        context.bot_data["summary_last_day"] = today_key
-
-    if now.hour != SUMMARY_HOUR or now.minute != SUMMARY_MINUTE:
+    """Scheduled once a day at SUMMARY_HOUR:SUMMARY_MINUTE via run_daily."""
+    today_key = str(datetime.now(ZoneInfo(TIMEZONE)).date())
+    clients   = await asyncio.to_thread(db.get_cached_active_clients)
+    if not clients:
         return
 
-    sent_today: set = context.bot_data["summary_sent"]
-    clients         = db.get_all_active_clients()
+    # Claim before sending so a restart or a second bot never sends twice
+    claimed = await asyncio.to_thread(db.claim_summary_deliveries, [c["id"] for c in clients], today_key)
+    clients = [c for c in clients if c["id"] in claimed]
+    if not clients:
+        return
 
-    for client in clients:
-        key = f"{client['id']}-{today_key}"
-        if key in sent_today:
-            continue
-        stats = db.get_today_stats(client["id"])
-        try:
-            await send_event_notification(client, "daily_summary", {
-                "order_count": stats["order_count"],
-                "revenue":     float(stats["revenue"]),
-                "avg_order":   float(stats["avg_order"]),
-                "date":        today_key,
-            })
-            sent_today.add(key)
+    # One GROUP BY for everyone, then overlap the Telegram round trips
+    stats_by_client = await asyncio.to_thread(db.get_today_stats_bulk)
+    results = await asyncio.gather(
+        *(_send_summary(c, stats_by_client.get(c["id"], db.ZERO_STATS), today_key) for c in clients),
+        return_exceptions=True,
+    )
+    for client, result in zip(clients, results):
+        if isinstance(result, Exception):
+            log.error(f"Daily summary failed for {client['name']}: {result}")
+        else:
             log.info(f"Daily summary sent to {client['name']}")
-        except Exception as e:
-            log.error(f"Daily summary failed for {client['name']}: {e}")
+
+
+async def _send_summary(client: dict, stats: dict, today_key: str):
+    await send_event_notification(client, "daily_summary", {
+        "order_count": stats["order_count"],
+        "revenue":     float(stats["revenue"]),
+        "avg_order":   float(stats["avg_order"]),
+        "date":        today_key,
+    })
 
 
 # ======================
 # MAIN
 # ======================
 
+async def _post_init(app: Application):
+    start_send_workers()
+
+
+async def _post_stop(app: Application):
+    # Still inside the running loop with the bot open — flush queued sends
+    await stop_send_workers()
+
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    db.init_db()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(10.0)
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .build()
+    )
+    # Notifications (daily summary) go out over the same HTTP pool as replies
+    set_bot(app.bot)
 
     app.add_handler(CommandHandler("start",       cmd_start))
     app.add_handler(CommandHandler("today",       cmd_today))
@@ -443,7 +497,10 @@ def main():
     # Catches owner's reply text when in awaiting_reply state
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reply_message))
 
-    app.job_queue.run_repeating(daily_summary_job, interval=60, first=10)
+    app.job_queue.run_daily(
+        daily_summary_job,
+        time=dt_time(SUMMARY_HOUR, SUMMARY_MINUTE, tzinfo=ZoneInfo(TIMEZONE)),
+    )
 
     log.info(f"✅ Relay bot starting — group ID: {TELEGRAM_GROUP_ID}")
     app.run_polling(drop_pending_updates=True)
@@ -21,6 +21,13 @@ DB_NAME     = os.getenv("DB_NAME", "relay")
 DB_USER     = os.getenv("DB_USER", "relay_user")
 DB_PASS     = os.getenv("DB_PASS", "changeme")
 
+# Connections per process (API worker or bot). DB_POOL_MIN are opened at
+# startup; more are opened on demand up to DB_POOL_MAX and then kept open.
+# Budget: (API workers + 1 bot) x (DB_POOL_MAX + 1 LISTEN/setup connection)
+# must stay below PostgreSQL's max_connections.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
 # ======================
 # API SERVER
 # ======================
@@ -28,10 +35,21 @@ DB_PASS     = os.getenv("DB_PASS", "changeme")
 API_HOST    = os.getenv("API_HOST", "0.0.0.0")
 API_PORT    = int(os.getenv("API_PORT", "8000"))
 
+# Concurrent requests per worker before the API starts answering 503
+API_MAX_IN_FLIGHT = int(os.getenv("API_MAX_IN_FLIGHT", "200"))
+
 # Client API secret — PHP/webhook sites send this in Authorization header.
 # Generate with: python3 -c "import secrets; print(secrets.token_hex(32))"
 API_SECRET  = os.getenv("API_SECRET", "change-this-before-deploying")
 
+# Store slugs as they appear in API URLs. setup_client.py and the bot's /start
+# validate against the same pattern, so every slug they accept is routable.
+SLUG_PATTERN = r"^[a-z0-9][a-z0-9-]{1,62}$"
+
+# How long /chat/{id}/poll holds the request open waiting for a reply.
+# Keep it below the proxy read timeout (see nginx.conf).
+CHAT_POLL_TIMEOUT = int(os.getenv("CHAT_POLL_TIMEOUT", "20"))
+
 # ======================
 # TELEGRAM
 # ======================
@@ -43,6 +61,9 @@ BOT_TOKEN           = os.getenv("BOT_TOKEN", "")
 # Your group ID: -5289768910
 TELEGRAM_GROUP_ID   = int(os.getenv("TELEGRAM_GROUP_ID", "-5289768910"))
 
+# Keep-alive connections to api.telegram.org shared by all notification sends
+TELEGRAM_POOL_SIZE  = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+
 # ======================
 # DAILY SUMMARY
 # ======================
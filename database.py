@@ -4,17 +4,40 @@
 
 import time
 import json
+import secrets
+import threading
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
-from typing import Optional, Dict, List
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
+import psycopg2.extensions
+from cachetools import TTLCache
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Optional, Dict, List, Tuple
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, DB_POOL_MIN, DB_POOL_MAX
 
 
 # ======================
 # CONNECTION
 # ======================
+# One pool per process. Connections stay open between calls so queries
+# don't pay the TCP + auth handshake every time.
 
-def get_connection():
+_pool: Optional[ThreadedConnectionPool] = None
+_pool_lock  = threading.Lock()
+# ThreadedConnectionPool raises when exhausted — make callers wait instead.
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Remembers which statements have been PREPAREd on this session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _connect():
+    """Open a standalone connection (schema setup, scripts)."""
     conn = psycopg2.connect(
         host=DB_HOST, port=DB_PORT,
         dbname=DB_NAME, user=DB_USER, password=DB_PASS,
@@ -23,14 +46,121 @@ def get_connection():
     return conn
 
 
+def init_pool() -> ThreadedConnectionPool:
+    """Open the connection pool. Safe to call more than once."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX,
+                host=DB_HOST, port=DB_PORT,
+                dbname=DB_NAME, user=DB_USER, password=DB_PASS,
+                connection_factory=_PooledConnection,
+            )
+            # The pool opens `minconn` up front and closes any returned
+            # connection beyond `minconn` idle ones. Raising it after creation
+            # opens lazily but keeps every connection (and its prepared
+            # statements) once opened.
+            _pool.minconn = DB_POOL_MAX
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def execute_prepared(cur, name: str, sql: str, params: tuple):
+    """
+    Run `sql` ($1, $2… placeholders) as a server-side prepared statement.
+    Parsed and planned once per pooled connection, then only EXECUTEd —
+    init_pool() keeps connections open once created, so this is paid once.
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+def listen(*channels: str):
+    """Open a dedicated autocommit connection subscribed to one or more NOTIFY channels."""
+    conn = _connect()
+    conn.autocommit = True
+    cur  = conn.cursor()
+    for channel in channels:
+        cur.execute(f"LISTEN {channel}")
+    cur.close()
+    return conn
+
+
+@contextmanager
+def cursor(dict_rows: bool = False):
+    """
+    Borrow a pooled connection for one unit of work. Commits when the block
+    finishes; on an exception the connection goes back rolled back.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor if dict_rows else None) as cur:
+            yield cur
+        conn.commit()
+    finally:
+        put_connection(conn)
+
+
+def pool_in_use() -> int:
+    """Connections currently borrowed from the pool (for /health)."""
+    return DB_POOL_MAX - _pool_slots._value
+
+
+def get_connection():
+    """Borrow a pooled connection. Always hand it back with put_connection()."""
+    _pool_slots.acquire()
+    try:
+        return (_pool or init_pool()).getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+def put_connection(conn):
+    """Return a connection to the pool. Any open transaction is rolled back."""
+    try:
+        if _pool is not None:
+            _pool.putconn(conn)
+        else:
+            conn.close()
+    finally:
+        _pool_slots.release()
+
+
+def _now() -> int:
+    """Current unix time in whole seconds, without the float round trip."""
+    return time.time_ns() // 1_000_000_000
+
+
 # ======================
 # SCHEMA SETUP
 # ======================
 
+_INITIALIZED = False
+# Arbitrary key for pg_advisory_xact_lock — serialises schema setup
+# when the bot and several API workers start at the same moment.
+_SCHEMA_LOCK_KEY = 0x72656C6179
+
+
 def init_db():
-    """Create all tables. Safe to call on every startup."""
-    conn = get_connection()
+    """Create all tables. Called once at process startup; repeat calls are no-ops."""
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+    conn = _connect()
     cur  = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK_KEY,))
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS clients (
@@ -93,9 +223,63 @@ def init_db():
         )
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id  TEXT PRIMARY KEY,
+            client_id   INTEGER NOT NULL REFERENCES clients(id),
+            visitor_id  TEXT,
+            page        TEXT,
+            status      TEXT DEFAULT 'open',
+            created_at  BIGINT NOT NULL,
+            updated_at  BIGINT NOT NULL
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id          SERIAL PRIMARY KEY,
+            session_id  TEXT NOT NULL REFERENCES chat_sessions(session_id),
+            sender      TEXT NOT NULL,
+            message     TEXT NOT NULL,
+            created_at  BIGINT NOT NULL
+        )
+    """)
+
+    # One row per delivered daily summary — the primary key makes the job idempotent
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS summary_deliveries (
+            client_id   INTEGER NOT NULL REFERENCES clients(id),
+            day_key     TEXT NOT NULL,
+            sent_at     BIGINT NOT NULL,
+            PRIMARY KEY (client_id, day_key)
+        )
+    """)
+
+    # Stats windows and the daily summary filter on (client_id, received_at)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_client_recv
+        ON orders (client_id, received_at) WHERE status != 'cancelled'
+    """)
+    # /orders — newest first per client
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_client_recv_desc
+        ON orders (client_id, received_at DESC)
+    """)
+    # Every bot command resolves its client by chat id
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_telegram_chats_chat_id
+        ON telegram_chats (chat_id) WHERE active
+    """)
+    # Chat polls read a session's messages after a given id
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_session
+        ON chat_messages (session_id, id)
+    """)
+
     conn.commit()
     cur.close()
     conn.close()
+    _INITIALIZED = True
     print("✅ Relay database initialized")
 
 
@@ -103,77 +287,148 @@ def init_db():
 # CLIENT MANAGEMENT
 # ======================
 
+def _client_row(row) -> Dict:
+    """Client dict plus derived fields the notifier reads on every message."""
+    client = dict(row)
+    client["_sym"] = client.get("currency_symbol") or "$"
+    return client
+
+
 def get_client_by_slug(slug: str) -> Optional[Dict]:
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM clients WHERE slug = %s AND active = TRUE", (slug,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row) if row else None
+    with cursor(dict_rows=True) as cur:
+        cur.execute("SELECT * FROM clients WHERE slug = %s AND active = TRUE", (slug,))
+        row = cur.fetchone()
+    return _client_row(row) if row else None
+
+
+# Clients are read on every API request but almost never change, so slug
+# lookups are cached briefly. Other processes see changes within the TTL.
+_client_cache = TTLCache(maxsize=1024, ttl=60)
+_cache_lock   = threading.Lock()
+
+
+def get_cached_client(slug: str) -> Optional[Dict]:
+    """Cache-only lookup — never touches the database."""
+    with _cache_lock:
+        return _client_cache.get(slug)
+
+
+def get_client_by_slug_cached(slug: str) -> Optional[Dict]:
+    client = get_cached_client(slug)
+    if client is None:
+        client = get_client_by_slug(slug)
+        if client:
+            # Encoded once here so API auth compares bytes on every request
+            client["api_secret_b"] = client["api_secret"].encode()
+            with _cache_lock:
+                _client_cache[slug] = client
+    return client
+
+
+def invalidate_client(slug: str):
+    """Drop a cached client — call after changing its secret or chat link."""
+    with _cache_lock:
+        _client_cache.pop(slug, None)
 
 
 def get_client_by_id(client_id: int) -> Optional[Dict]:
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM clients WHERE id = %s", (client_id,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row) if row else None
+    with cursor(dict_rows=True) as cur:
+        cur.execute("SELECT * FROM clients WHERE id = %s", (client_id,))
+        row = cur.fetchone()
+    return _client_row(row) if row else None
+
+
+# Every bot command resolves its client from the chat; links change only via /start
+_chat_cache = TTLCache(maxsize=1024, ttl=300)
 
 
 def get_client_by_chat_id(chat_id: int) -> Optional[Dict]:
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
-        SELECT c.* FROM clients c
-        JOIN telegram_chats tc ON tc.client_id = c.id
-        WHERE tc.chat_id = %s AND tc.active = TRUE AND c.active = TRUE
-        LIMIT 1
-    """, (chat_id,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row) if row else None
+    with _cache_lock:
+        client = _chat_cache.get(chat_id)
+    if client is not None:
+        return client
+    with cursor(dict_rows=True) as cur:
+        cur.execute("""
+            SELECT c.* FROM clients c
+            JOIN telegram_chats tc ON tc.client_id = c.id
+            WHERE tc.chat_id = %s AND tc.active = TRUE AND c.active = TRUE
+            LIMIT 1
+        """, (chat_id,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    client = _client_row(row)
+    with _cache_lock:
+        _chat_cache[chat_id] = client
+    return client
 
 
 def create_client(slug: str, name: str, api_secret: str,
                   timezone: str = "Asia/Kolkata", currency_symbol: str = "$") -> int:
-    now  = int(time.time())
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute("""
-        INSERT INTO clients (slug, name, api_secret, timezone, currency_symbol, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (slug, name, api_secret, timezone, currency_symbol, now))
-    client_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close(); conn.close()
+    now  = _now()
+    with cursor() as cur:
+        cur.execute("""
+            INSERT INTO clients (slug, name, api_secret, timezone, currency_symbol, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (slug, name, api_secret, timezone, currency_symbol, now))
+        client_id = cur.fetchone()[0]
+    invalidate_active_clients()
     return client_id
 
 
 def set_client_chat(client_id: int, chat_id: int, chat_type: str = "private", label: str = None):
-    now  = int(time.time())
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute("""
-        INSERT INTO telegram_chats (client_id, chat_id, chat_type, label, added_at)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (client_id, chat_id) DO UPDATE SET
-            active = TRUE,
-            label  = EXCLUDED.label
-    """, (client_id, chat_id, chat_type, label, now))
-    cur.execute("UPDATE clients SET telegram_chat_id = %s WHERE id = %s", (chat_id, client_id))
-    conn.commit()
-    cur.close(); conn.close()
+    now  = _now()
+    with cursor() as cur:
+        # Link the chat and point the client at it in one statement
+        cur.execute("""
+            WITH upserted AS (
+                INSERT INTO telegram_chats (client_id, chat_id, chat_type, label, added_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (client_id, chat_id) DO UPDATE SET
+                    active = TRUE,
+                    label  = EXCLUDED.label
+                RETURNING client_id, chat_id
+            )
+            UPDATE clients SET telegram_chat_id = upserted.chat_id
+            FROM upserted
+            WHERE clients.id = upserted.client_id
+        """, (client_id, chat_id, chat_type, label, now))
+    with _cache_lock:
+        _chat_cache.pop(chat_id, None)
+    invalidate_active_clients()
 
 
 def get_all_active_clients() -> List[Dict]:
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM clients WHERE active = TRUE AND telegram_chat_id IS NOT NULL")
-    rows = cur.fetchall()
-    cur.close(); conn.close()
-    return [dict(r) for r in rows]
+    # Plain tuples + one column list; cheaper than a RealDictRow per client
+    with cursor() as cur:
+        cur.execute("SELECT * FROM clients WHERE active = TRUE AND telegram_chat_id IS NOT NULL")
+        cols = [c.name for c in cur.description]
+        rows = cur.fetchall()
+    return [_client_row(zip(cols, r)) for r in rows]
+
+
+# The active set only changes when a store is added or linked, both of which
+# invalidate it here. Changes made by another process show up on the next refresh.
+ACTIVE_CLIENTS_REFRESH = 600
+_active_clients: Optional[List[Dict]] = None
+_active_clients_at = 0
+_active_lock = threading.Lock()
+
+
+def get_cached_active_clients() -> List[Dict]:
+    global _active_clients, _active_clients_at
+    with _active_lock:
+        if _active_clients is None or _now() - _active_clients_at >= ACTIVE_CLIENTS_REFRESH:
+            _active_clients    = get_all_active_clients()
+            _active_clients_at = _now()
+        return list(_active_clients)
+
+
+def invalidate_active_clients():
+    global _active_clients
+    with _active_lock:
+        _active_clients = None
 
 
 # ======================
@@ -181,136 +436,360 @@ def get_all_active_clients() -> List[Dict]:
 # ======================
 
 def get_setting(client_id: int, key: str) -> Optional[str]:
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute(
-        "SELECT value FROM settings WHERE client_id = %s AND key = %s",
-        (client_id, key)
-    )
-    row = cur.fetchone()
-    cur.close(); conn.close()
+    with cursor() as cur:
+        cur.execute(
+            "SELECT value FROM settings WHERE client_id = %s AND key = %s",
+            (client_id, key)
+        )
+        row = cur.fetchone()
     return row[0] if row else None
 
 
-def set_setting(client_id: int, key: str, value: str):
-    now  = int(time.time())
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute("""
-        INSERT INTO settings (client_id, key, value, updated_at)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (client_id, key) DO UPDATE SET
-            value      = EXCLUDED.value,
-            updated_at = EXCLUDED.updated_at
-    """, (client_id, key, value, now))
-    conn.commit()
-    cur.close(); conn.close()
+# Settings are polled by every client site (maintenance mode), so reads
+# are cached for a few seconds. The API reads them but the bot writes them,
+# so set_setting() announces the change on SETTINGS_CHANNEL (payload
+# "<client_id>:<key>") and listeners call evict_setting().
+_setting_cache = TTLCache(maxsize=4096, ttl=15)
+_MISSING = object()
+
+SETTINGS_CHANNEL = "relay_settings"
+
+
+def evict_setting(payload: str):
+    """Drop one cached setting named by a SETTINGS_CHANNEL payload."""
+    client_id, _, key = payload.partition(":")
+    with _cache_lock:
+        _setting_cache.pop((int(client_id), key), None)
+
+
+def clear_setting_cache():
+    """Forget every cached setting — e.g. after missing announcements."""
+    with _cache_lock:
+        _setting_cache.clear()
+
+
+def get_setting_cached(client_id: int, key: str) -> Optional[str]:
+    with _cache_lock:
+        value = _setting_cache.get((client_id, key), _MISSING)
+    if value is _MISSING:
+        value = get_setting(client_id, key)
+        with _cache_lock:
+            _setting_cache[(client_id, key)] = value
+    return value
+
+
+def set_setting(client_id: int, key: str, value: str, now: int = None):
+    now  = now or _now()
+    with cursor() as cur:
+        cur.execute("""
+            INSERT INTO settings (client_id, key, value, updated_at)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (client_id, key) DO UPDATE SET
+                value      = EXCLUDED.value,
+                updated_at = EXCLUDED.updated_at
+        """, (client_id, key, value, now))
+        # Delivered on commit, to every process listening
+        cur.execute("SELECT pg_notify(%s, %s)", (SETTINGS_CHANNEL, f"{client_id}:{key}"))
+    with _cache_lock:
+        _setting_cache.pop((client_id, key), None)
 
 
 # ======================
 # ORDER TRACKING
 # ======================
 
+# /today is answered by the bot, but orders are written by the API processes,
+# so nothing can evict this locally: the bot's figures trail new orders by up
+# to the TTL.
+_today_cache = TTLCache(maxsize=1024, ttl=30)
+
+_INSERT_ORDER_SQL = """
+    INSERT INTO orders (client_id, order_number, customer_name, total, item_count, received_at, created_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    RETURNING id
+"""
+
+
 def record_order(client_id: int, order_number: str, customer_name: str,
-                 total: float, item_count: int = 1, received_at: int = None) -> int:
-    now  = int(time.time())
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute("""
-        INSERT INTO orders (client_id, order_number, customer_name, total, item_count, received_at, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (client_id, order_number, customer_name, total, item_count, received_at or now, now))
-    order_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close(); conn.close()
+                 total: float, item_count: int = 1, received_at: int = None,
+                 now: int = None) -> int:
+    now  = now or _now()
+    with cursor() as cur:
+        execute_prepared(cur, "insert_order", _INSERT_ORDER_SQL,
+                         (client_id, order_number, customer_name, total, item_count, received_at or now, now))
+        order_id = cur.fetchone()[0]
     return order_id
 
 
+def record_orders_bulk(client_id: int, orders: List[Dict], now: int = None) -> List[int]:
+    """Insert a batch of orders in one statement and one commit. Returns ids in input order."""
+    if not orders:
+        return []
+    now  = now or _now()
+    rows = [
+        (client_id, o["order_number"], o.get("customer_name"), o["total"],
+         o.get("item_count", 1), o.get("received_at") or now, now)
+        for o in orders
+    ]
+    with cursor() as cur:
+        result = psycopg2.extras.execute_values(cur, """
+            INSERT INTO orders (client_id, order_number, customer_name, total, item_count, received_at, created_at)
+            VALUES %s
+            RETURNING id
+        """, rows, page_size=500, fetch=True)
+    return [r[0] for r in result]
+
+
+_WINDOW_STATS_SQL = """
+    SELECT
+        COUNT(*)                AS order_count,
+        COALESCE(SUM(total), 0) AS revenue,
+        COALESCE(AVG(total), 0) AS avg_order
+    FROM orders
+    WHERE client_id = $1 AND received_at >= $2 AND status != 'cancelled'
+"""
+
+
+def get_window_stats(client_id: int, since: int) -> Dict:
+    """Order count, revenue and average for orders received at or after `since`."""
+    with cursor() as cur:
+        execute_prepared(cur, "window_stats", _WINDOW_STATS_SQL, (client_id, since))
+        r = cur.fetchone()
+    return {"order_count": r[0], "revenue": r[1], "avg_order": r[2]}
+
+
 def get_today_stats(client_id: int) -> Dict:
-    today_start = int(time.time()) // 86400 * 86400
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
-        SELECT
-            COUNT(*)                AS order_count,
-            COALESCE(SUM(total), 0) AS revenue,
-            COALESCE(AVG(total), 0) AS avg_order
-        FROM orders
-        WHERE client_id = %s AND received_at >= %s AND status != 'cancelled'
-    """, (client_id, today_start))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row)
+    today_start = _now() // 86400 * 86400
+    with _cache_lock:
+        hit = _today_cache.get(client_id)
+    if hit and hit[0] == today_start:
+        return dict(hit[1])
+    stats = get_window_stats(client_id, today_start)
+    with _cache_lock:
+        _today_cache[client_id] = (today_start, stats)
+    return dict(stats)
 
 
 def get_week_stats(client_id: int) -> Dict:
-    week_start = int(time.time()) - (7 * 86400)
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
-        SELECT
-            COUNT(*)                AS order_count,
-            COALESCE(SUM(total), 0) AS revenue,
-            COALESCE(AVG(total), 0) AS avg_order
-        FROM orders
-        WHERE client_id = %s AND received_at >= %s AND status != 'cancelled'
-    """, (client_id, week_start))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row)
+    return get_window_stats(client_id, _now() - (7 * 86400))
 
 
 def get_month_stats(client_id: int) -> Dict:
-    month_start = int(time.time()) - (30 * 86400)
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
+    return get_window_stats(client_id, _now() - (30 * 86400))
+
+
+# Bot stats commands need the chat's client and its stats; on a chat-cache
+# miss both come back from one statement instead of two round trips.
+_CLIENT_WINDOW_STATS_SQL = """
+    SELECT c.*, s.order_count, s.revenue, s.avg_order
+    FROM clients c
+    JOIN telegram_chats tc ON tc.client_id = c.id
+    CROSS JOIN LATERAL (
         SELECT
             COUNT(*)                AS order_count,
             COALESCE(SUM(total), 0) AS revenue,
             COALESCE(AVG(total), 0) AS avg_order
         FROM orders
-        WHERE client_id = %s AND received_at >= %s AND status != 'cancelled'
-    """, (client_id, month_start))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return dict(row)
+        WHERE client_id = c.id AND received_at >= %s AND status != 'cancelled'
+    ) s
+    WHERE tc.chat_id = %s AND tc.active = TRUE AND c.active = TRUE
+    LIMIT 1
+"""
+
+
+def get_client_and_window_stats(chat_id: int, since: int) -> Optional[Tuple[Dict, Dict]]:
+    """(client, stats) for the store linked to this chat, or None if it isn't linked."""
+    with _cache_lock:
+        client = _chat_cache.get(chat_id)
+    if client is not None:
+        return client, get_window_stats(client["id"], since)
+    with cursor(dict_rows=True) as cur:
+        cur.execute(_CLIENT_WINDOW_STATS_SQL, (since, chat_id))
+        row = cur.fetchone()
+    if not row:
+        return None
+    client = _client_row(row)
+    stats  = {
+        "order_count": client.pop("order_count"),
+        "revenue":     client.pop("revenue"),
+        "avg_order":   client.pop("avg_order"),
+    }
+    with _cache_lock:
+        _chat_cache[chat_id] = client
+    return client, stats
+
+
+def get_client_and_today_stats(chat_id: int) -> Optional[Tuple[Dict, Dict]]:
+    with _cache_lock:
+        client = _chat_cache.get(chat_id)
+    if client is not None:
+        return client, get_today_stats(client["id"])
+    today_start = _now() // 86400 * 86400
+    found = get_client_and_window_stats(chat_id, today_start)
+    if found:
+        with _cache_lock:
+            _today_cache[found[0]["id"]] = (today_start, dict(found[1]))
+    return found
+
+
+def get_client_and_week_stats(chat_id: int) -> Optional[Tuple[Dict, Dict]]:
+    return get_client_and_window_stats(chat_id, _now() - (7 * 86400))
+
+
+def get_client_and_month_stats(chat_id: int) -> Optional[Tuple[Dict, Dict]]:
+    return get_client_and_window_stats(chat_id, _now() - (30 * 86400))
+
+
+ZERO_STATS = {"order_count": 0, "revenue": 0, "avg_order": 0}
+
+
+def get_today_stats_bulk(today_start: int = None) -> Dict[int, Dict]:
+    """Today's stats for every client in one query. Clients with no orders are absent — use ZERO_STATS."""
+    today_start = today_start or _now() // 86400 * 86400
+    with cursor() as cur:
+        cur.execute("""
+            SELECT
+                client_id,
+                COUNT(*)                AS order_count,
+                COALESCE(SUM(total), 0) AS revenue,
+                COALESCE(AVG(total), 0) AS avg_order
+            FROM orders
+            WHERE received_at >= %s AND status != 'cancelled'
+            GROUP BY client_id
+        """, (today_start,))
+        rows = cur.fetchall()
+    return {r[0]: {"order_count": r[1], "revenue": r[2], "avg_order": r[3]} for r in rows}
+
+
+def claim_summary_deliveries(client_ids: List[int], day_key: str) -> set:
+    """
+    Record that today's summary is going out to these clients.
+    Returns only the ids that weren't already claimed for day_key.
+    """
+    if not client_ids:
+        return set()
+    with cursor() as cur:
+        cur.execute("""
+            INSERT INTO summary_deliveries (client_id, day_key, sent_at)
+            SELECT id, %s, %s FROM unnest(%s::int[]) AS id
+            ON CONFLICT (client_id, day_key) DO NOTHING
+            RETURNING client_id
+        """, (day_key, _now(), list(client_ids)))
+        return {row[0] for row in cur.fetchall()}
 
 
 def get_recent_orders(client_id: int, limit: int = 5) -> List[Dict]:
-    conn = get_connection()
-    cur  = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("""
-        SELECT order_number, customer_name, total, item_count, status, received_at
-        FROM orders
-        WHERE client_id = %s
-        ORDER BY received_at DESC
-        LIMIT %s
-    """, (client_id, limit))
-    rows = cur.fetchall()
-    cur.close(); conn.close()
-    return [dict(r) for r in rows]
+    with cursor() as cur:
+        cur.execute("""
+            SELECT order_number, customer_name, total, item_count, status, received_at
+            FROM orders
+            WHERE client_id = %s
+            ORDER BY received_at DESC
+            LIMIT %s
+        """, (client_id, limit))
+        cols = [c.name for c in cur.description]
+        rows = cur.fetchall()
+    return [dict(zip(cols, r)) for r in rows]
 
 
 # ======================
 # EVENT LOGGING
 # ======================
 
-def log_event(client_id: int, event_type: str, payload: dict = None):
-    now  = int(time.time())
-    conn = get_connection()
-    cur  = conn.cursor()
-    cur.execute("""
-        INSERT INTO events (client_id, event_type, payload, created_at)
-        VALUES (%s, %s, %s, %s)
-    """, (client_id, event_type, json.dumps(payload or {}), now))
-    conn.commit()
-    cur.close(); conn.close()
+_INSERT_EVENT_SQL = """
+    INSERT INTO events (client_id, event_type, payload, created_at)
+    VALUES ($1, $2, $3, $4)
+"""
+
+
+def log_event(client_id: int, event_type: str, payload: dict = None, now: int = None):
+    now  = now or _now()
+    with cursor() as cur:
+        # The event log is informational — don't make the request wait on the WAL flush.
+        # A crash can lose the last few hundred ms of events, never corrupt anything.
+        cur.execute("SET LOCAL synchronous_commit TO OFF")
+        execute_prepared(cur, "insert_event", _INSERT_EVENT_SQL,
+                         (client_id, event_type, json.dumps(payload or {}), now))
 
 
 # ======================
-# INIT ON IMPORT
+# WEBSITE CHAT
 # ======================
 
-init_db()
+# Every write to a session is announced on this channel so long-polling widgets
+# wake up no matter which process did the write. Payload: "<session_id>:<message id>"
+# for a new message, "<session_id>:closed" when the session is closed.
+CHAT_CHANNEL = "relay_chat"
+
+
+def create_chat_session(client_id: int, visitor_id: str, page: str = None) -> str:
+    now        = _now()
+    # The id is the only credential on /chat/{id}/poll — 64 bits, not guessable
+    session_id = secrets.token_hex(8).upper()
+    with cursor() as cur:
+        cur.execute("""
+            INSERT INTO chat_sessions (session_id, client_id, visitor_id, page, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (session_id, client_id, visitor_id, page, now, now))
+    return session_id
+
+
+def get_chat_session(session_id: str) -> Optional[Dict]:
+    with cursor(dict_rows=True) as cur:
+        cur.execute("SELECT * FROM chat_sessions WHERE session_id = %s", (session_id,))
+        row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def get_open_sessions_for_client(client_id: int) -> List[Dict]:
+    with cursor(dict_rows=True) as cur:
+        cur.execute("""
+            SELECT session_id, visitor_id, page, created_at, updated_at
+            FROM chat_sessions
+            WHERE client_id = %s AND status = 'open'
+            ORDER BY updated_at DESC
+        """, (client_id,))
+        rows = cur.fetchall()
+    return [dict(r) for r in rows]
+
+
+def close_chat_session(session_id: str):
+    now  = _now()
+    with cursor() as cur:
+        cur.execute(
+            "UPDATE chat_sessions SET status = 'closed', updated_at = %s WHERE session_id = %s",
+            (now, session_id)
+        )
+        cur.execute("SELECT pg_notify(%s, %s)", (CHAT_CHANNEL, f"{session_id}:closed"))
+
+
+_INSERT_CHAT_MESSAGE_SQL = """
+    INSERT INTO chat_messages (session_id, sender, message, created_at)
+    VALUES ($1, $2, $3, $4)
+    RETURNING id
+"""
+
+
+def add_chat_message(session_id: str, sender: str, message: str) -> int:
+    now  = _now()
+    with cursor() as cur:
+        execute_prepared(cur, "insert_chat_message", _INSERT_CHAT_MESSAGE_SQL,
+                         (session_id, sender, message, now))
+        message_id = cur.fetchone()[0]
+        cur.execute("UPDATE chat_sessions SET updated_at = %s WHERE session_id = %s", (now, session_id))
+        cur.execute("SELECT pg_notify(%s, %s)", (CHAT_CHANNEL, f"{session_id}:{message_id}"))
+    return message_id
+
+
+def get_chat_messages(session_id: str, since: int = 0) -> List[Dict]:
+    """Messages with id > since, oldest first. The widget passes back the last id it saw."""
+    with cursor(dict_rows=True) as cur:
+        cur.execute("""
+            SELECT id, sender, message, created_at
+            FROM chat_messages
+            WHERE session_id = %s AND id > %s
+            ORDER BY id
+        """, (session_id, since))
+        rows = cur.fetchall()
+    return [dict(r) for r in rows]
+
@@ -2,75 +2,289 @@
 # All Telegram message formatting lives here.
 
 import time
+import asyncio
+import logging
+from functools import lru_cache
+from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from config import BOT_TOKEN
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from config import BOT_TOKEN, TELEGRAM_POOL_SIZE, TIMEZONE
+
+log = logging.getLogger("relay.notifier")
 
 _bot: Bot = None
 
 def get_bot() -> Bot:
     global _bot
     if _bot is None:
-        _bot = Bot(token=BOT_TOKEN)
+        # One keep-alive HTTP client per process, sized for concurrent sends
+        # (the library default is a single connection).
+        _bot = Bot(
+            token=BOT_TOKEN,
+            request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE, pool_timeout=10.0),
+        )
     return _bot
 
 
+def set_bot(bot: Bot):
+    """Send through an existing Bot (e.g. the bot process's Application) instead of a second client."""
+    global _bot
+    _bot = bot
+
+
+async def close_bot():
+    global _bot
+    if _bot is not None:
+        await _bot.request.shutdown()
+        _bot = None
+
+
+# ======================
+# SEND QUEUE
+# ======================
+# Every outgoing message goes through a small pool of workers. A 429 from
+# Telegram pauses all of them for retry_after instead of each sender retrying
+# on its own, and a full queue pushes back on producers.
+
+SEND_WORKERS     = 4
+SEND_MAX_RETRIES = 3
+
+_send_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+_send_workers: list[asyncio.Task] = []
+_resume_at = 0.0    # loop time before which no worker sends
+
+
+async def _send(**kwargs):
+    """
+    send_message() through the worker pool; returns or raises what it did.
+    Sends directly when no workers are running (scripts, tests).
+    """
+    if not _send_workers:
+        return await get_bot().send_message(**kwargs)
+    fut = asyncio.get_running_loop().create_future()
+    await _send_queue.put((kwargs, fut))
+    return await fut
+
+
+async def _send_worker():
+    global _resume_at
+    loop = asyncio.get_running_loop()
+    # Resolved once: set_bot() runs before workers start and close_bot() after they stop
+    bot  = get_bot()
+    while True:
+        kwargs, fut = await _send_queue.get()
+        try:
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                if (wait := _resume_at - loop.time()) > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    result = await bot.send_message(**kwargs)
+                except RetryAfter as e:
+                    _resume_at = max(_resume_at, loop.time() + float(e.retry_after))
+                    log.warning(f"Telegram rate limit — pausing sends for {e.retry_after}s")
+                    if attempt == SEND_MAX_RETRIES and not fut.done():
+                        fut.set_exception(e)
+                    continue
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(result)
+                break
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        finally:
+            _send_queue.task_done()
+
+
+async def send_many(jobs: list) -> list:
+    """
+    Send (chat_id, text) pairs concurrently. Returns one result per job —
+    the sent Message or the exception — in the same order.
+    """
+    return await asyncio.gather(
+        *(_send(chat_id=chat_id, text=text, parse_mode=_PM) for chat_id, text in jobs),
+        return_exceptions=True,
+    )
+
+
+async def broadcast(chat_ids, text: str) -> list:
+    """Send one already-formatted text to many chats. Format once, then call this."""
+    return await send_many([(chat_id, text) for chat_id in chat_ids])
+
+
+def start_send_workers(n: int = SEND_WORKERS):
+    """Start the send workers on the running loop. Call once per process."""
+    if not _send_workers:
+        _send_workers.extend(asyncio.create_task(_send_worker()) for _ in range(n))
+
+
+async def stop_send_workers():
+    """Drain queued sends, then stop the workers."""
+    if not _send_workers:
+        return
+    await _send_queue.join()
+    for task in _send_workers:
+        task.cancel()
+    await asyncio.gather(*_send_workers, return_exceptions=True)
+    _send_workers.clear()
+
+
 # ======================
 # FORMATTERS
 # ======================
 
+@lru_cache(maxsize=1024)
 def _fmt_currency(amount: float, symbol: str = "$") -> str:
     return f"{symbol}{amount:,.2f}"
 
-def _fmt_time(ts: int) -> str:
-    return time.strftime("%I:%M %p", time.localtime(ts))
+@lru_cache(maxsize=64)
+def _zone(name: str) -> ZoneInfo:
+    """ZoneInfo per client timezone, loaded once. Unknown names fall back to TIMEZONE."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(TIMEZONE)
+
+# Times are shown in the store's own timezone. The output only changes once a
+# minute (time) or at local midnight (date), so cache by bucket. Every UTC
+# offset is a multiple of 15 minutes, so a 15-minute bucket never straddles
+# a local date change.
 
-def _fmt_date(ts: int) -> str:
-    return time.strftime("%b %d, %Y", time.localtime(ts))
+@lru_cache(maxsize=256)
+def _fmt_time_bucket(minute: int, tz: str) -> str:
+    return datetime.fromtimestamp(minute * 60, _zone(tz)).strftime("%I:%M %p")
+
+def _fmt_time(ts: int, tz: str = TIMEZONE) -> str:
+    return _fmt_time_bucket(ts // 60, tz)
+
+@lru_cache(maxsize=256)
+def _fmt_date_bucket(quarter_hour: int, tz: str) -> str:
+    return datetime.fromtimestamp(quarter_hour * 900, _zone(tz)).strftime("%b %d, %Y")
+
+def _fmt_date(ts: int, tz: str = TIMEZONE) -> str:
+    return _fmt_date_bucket(ts // 900, tz)
+
+
+# ======================
+# TEMPLATES
+# ======================
+# Positional %-templates: one PyUnicode_Format call per message, no kwargs dict.
+
+_ORDER_TMPL = (
+    "🛒 *New Order*\n"
+    "\n"
+    "#%s\n"
+    "%s\n"
+    "%s · *%s*\n"
+    "\n"
+    "_%s_"
+)
+
+_LOW_STOCK_TMPL = (
+    "⚠️ *Low Stock Alert*\n"
+    "\n"
+    "%s\n"
+    "Only *%s* left"
+)
+
+_CONTACT_FORM_TMPL = (
+    "📩 *Contact Form*\n"
+    "\n"
+    "From: %s\n"
+    "Re: %s\n"
+    "\n"
+    "_Check your email for the full message_"
+)
+
+_PM = "Markdown"
+
+# Store- and visitor-supplied text can contain Markdown markers; an unbalanced
+# one makes Telegram reject the whole message. Escaping only works outside an
+# entity, so this is applied to fields that aren't inside *bold*/_italic_/`code`.
+_MD_ESCAPE = str.maketrans({"_": r"\_", "*": r"\*", "`": r"\`", "[": r"\["})
+
+def _md(value) -> str:
+    return str(value).translate(_MD_ESCAPE)
+
+# Fallbacks for fields the store didn't send
+_UNKNOWN          = "Unknown"
+_UNKNOWN_CUSTOMER = "Unknown customer"
+_UNKNOWN_PRODUCT  = "Unknown product"
+
+_MAINTENANCE_ON_TEXT  = "🔧 *Maintenance Mode ON*\nStore is now offline for visitors."
+_MAINTENANCE_OFF_TEXT = "✅ *Maintenance Mode OFF*\nStore is back online."
+
+# format_map rather than %: the currency formatting happens inside the template
+_PERIOD_TMPL = (
+    "📊 *{title}*\n"
+    "\n"
+    "Orders: *{order_count}*\n"
+    "Revenue: *{symbol}{revenue:,.2f}*\n"
+    "Avg order: *{symbol}{avg_order:,.2f}*"
+)
+
+_DAILY_SUMMARY_TMPL = (
+    "📊 *Daily Summary — %s*\n"
+    "\n"
+    "Orders: *%s*\n"
+    "Revenue: *%s*\n"
+    "Avg order: *%s*"
+)
 
 
 # ======================
 # NOTIFICATION SENDERS
 # ======================
 
-async def send_order_notification(client: dict, order: dict):
+async def send_order_notification(client: dict, order):
+    """
+    Queue an order for the batcher — see run_order_batcher().
+    `order` is the validated api.OrderEvent; fields are read as attributes.
+    """
     if not client.get("telegram_chat_id"):
         return
-    symbol     = client.get("currency_symbol", "$")
-    name       = order.get("customer_name") or "Unknown customer"
-    total      = _fmt_currency(order["total"], symbol)
-    order_num  = order["order_number"]
-    items      = order.get("item_count", 1)
-    item_label = f"{items} item" if items == 1 else f"{items} items"
-    text = (
-        f"🛒 *New Order*\n"
-        f"\n"
-        f"#{order_num}\n"
-        f"{name}\n"
-        f"{item_label} · *{total}*\n"
-        f"\n"
-        f"_{_fmt_time(int(time.time()))}_"
-    )
-    await get_bot().send_message(
-        chat_id=client["telegram_chat_id"],
-        text=text,
-        parse_mode="Markdown",
-    )
+    await _order_queue.put((client, order))
 
 
-async def send_event_notification(client: dict, event_type: str, payload: dict):
+def queue_order_notification(client: dict, order) -> bool:
+    """
+    Non-blocking send_order_notification() for request handlers — no task needed.
+    Returns False only when the queue is full; the caller decides how to back off.
+    """
     if not client.get("telegram_chat_id"):
+        return True
+    try:
+        _order_queue.put_nowait((client, order))
+    except asyncio.QueueFull:
+        return False
+    return True
+
+
+async def send_event_notification(client: dict, event_type: str, payload: dict):
+    fn = _EVENT_FORMATTERS.get(event_type)
+    if fn is None or not client.get("telegram_chat_id"):
         return
-    symbol = client.get("currency_symbol", "$")
-    text   = _format_event(event_type, payload, symbol)
+    text = fn(payload, client["_sym"])
     if not text:
         return
-    await get_bot().send_message(
+    await _send(
         chat_id=client["telegram_chat_id"],
         text=text,
-        parse_mode="Markdown",
+        parse_mode=_PM,
     )
 
 
+def _reply_callback(session_id: str, visitor_name: str) -> str:
+    """Reply button payload. Telegram rejects the whole message past 64 bytes, so trim the name."""
+    data = f"reply:{session_id}:{visitor_name}".encode()[:64]
+    return data.decode(errors="ignore")
+
+
 async def send_chat_notification(client: dict, session_id: str, visitor_name: str, page: str, first_message: str):
     """
     Fires when a visitor starts a new chat session.
@@ -81,9 +295,9 @@ async def send_chat_notification(client: dict, session_id: str, visitor_name: st
 
     page_label = page or "/"
     text = (
-        f"💬 *New Chat — {visitor_name}*\n"
+        f"💬 *New Chat* — {_md(visitor_name)}\n"
         f"\n"
-        f"{first_message}\n"
+        f"{_md(first_message)}\n"
         f"\n"
         f"📄 Page: `{page_label}`\n"
         f"🔑 Session: `{session_id}`"
@@ -91,15 +305,15 @@ async def send_chat_notification(client: dict, session_id: str, visitor_name: st
 
     keyboard = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("💬 Reply", callback_data=f"reply:{session_id}:{visitor_name}"),
+            InlineKeyboardButton("💬 Reply", callback_data=_reply_callback(session_id, visitor_name)),
             InlineKeyboardButton("🔒 Close", callback_data=f"close:{session_id}"),
         ]
     ])
 
-    await get_bot().send_message(
+    await _send(
         chat_id=client["telegram_chat_id"],
         text=text,
-        parse_mode="Markdown",
+        parse_mode=_PM,
         reply_markup=keyboard,
     )
 
@@ -110,109 +324,187 @@ async def send_chat_followup_notification(client: dict, session_id: str, visitor
         return
 
     text = (
-        f"💬 *{visitor_name}* (`{session_id}`)\n"
+        f"💬 {_md(visitor_name)} (`{session_id}`)\n"
         f"\n"
-        f"{message}"
+        f"{_md(message)}"
     )
 
     keyboard = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("💬 Reply", callback_data=f"reply:{session_id}:{visitor_name}"),
+            InlineKeyboardButton("💬 Reply", callback_data=_reply_callback(session_id, visitor_name)),
             InlineKeyboardButton("🔒 Close", callback_data=f"close:{session_id}"),
         ]
     ])
 
-    await get_bot().send_message(
+    await _send(
         chat_id=client["telegram_chat_id"],
         text=text,
-        parse_mode="Markdown",
+        parse_mode=_PM,
         reply_markup=keyboard,
     )
 
 
-def _format_event(event_type: str, payload: dict, symbol: str) -> str | None:
-    if event_type == "low_stock":
-        product = payload.get("product_name", "Unknown product")
-        qty     = payload.get("quantity", "?")
-        return (
-            f"⚠️ *Low Stock Alert*\n"
-            f"\n"
-            f"{product}\n"
-            f"Only *{qty}* left"
-        )
-    elif event_type == "contact_form":
-        from_name = payload.get("name", "Someone")
-        subject   = payload.get("subject", "no subject")
-        return (
-            f"📩 *Contact Form*\n"
-            f"\n"
-            f"From: {from_name}\n"
-            f"Re: {subject}\n"
-            f"\n"
-            f"_Check your email for the full message_"
-        )
-    elif event_type == "maintenance_on":
-        return "🔧 *Maintenance Mode ON*\nStore is now offline for visitors."
-    elif event_type == "maintenance_off":
-        return "✅ *Maintenance Mode OFF*\nStore is back online."
-    elif event_type == "daily_summary":
-        orders  = payload.get("order_count", 0)
-        revenue = _fmt_currency(payload.get("revenue", 0), symbol)
-        avg     = _fmt_currency(payload.get("avg_order", 0), symbol)
-        date    = payload.get("date", "Today")
-        return (
-            f"📊 *Daily Summary — {date}*\n"
-            f"\n"
-            f"Orders: *{orders}*\n"
-            f"Revenue: *{revenue}*\n"
-            f"Avg order: *{avg}*"
-        )
-    return None
+def _format_order(client: dict, order) -> str:
+    symbol     = client["_sym"]
+    name       = _md(order.customer_name or _UNKNOWN_CUSTOMER)
+    total      = _fmt_currency(order.total, symbol)
+    order_num  = _md(order.order_number)
+    items      = order.item_count
+    item_label = f"{items} item" if items == 1 else f"{items} items"
+    # The store's own timestamp when it sent one — no extra clock read
+    ts         = _fmt_time(order.received_at or time.time_ns() // 1_000_000_000,
+                           client.get("timezone") or TIMEZONE)
+    return _ORDER_TMPL % (order_num, name, item_label, total, ts)
+
+
+def _format_order_batch(client: dict, orders: list) -> str:
+    symbol = client["_sym"]
+    lines  = [f"🛒 *{len(orders)} New Orders*\n"]
+    for o in orders:
+        name = _md(o.customer_name or _UNKNOWN_CUSTOMER)
+        lines.append(f"#{_md(o.order_number)} · {name} · *{_fmt_currency(o.total, symbol)}*")
+    lines.append(f"\nTotal: *{_fmt_currency(sum(o.total for o in orders), symbol)}*")
+    lines.append(f"_{_fmt_time(time.time_ns() // 1_000_000_000, client.get('timezone') or TIMEZONE)}_")
+    return "\n".join(lines)
+
+
+def _format_low_stock(payload: dict, symbol: str) -> str:
+    product = _md(payload.get("product_name", _UNKNOWN_PRODUCT))
+    qty     = payload.get("quantity", "?")
+    return _LOW_STOCK_TMPL % (product, qty)
+
+
+def _format_contact_form(payload: dict, symbol: str) -> str:
+    from_name = _md(payload.get("name", "Someone"))
+    subject   = _md(payload.get("subject", "no subject"))
+    return _CONTACT_FORM_TMPL % (from_name, subject)
+
+
+def _format_maintenance_on(payload: dict, symbol: str) -> str:
+    return _MAINTENANCE_ON_TEXT
+
+
+def _format_maintenance_off(payload: dict, symbol: str) -> str:
+    return _MAINTENANCE_OFF_TEXT
+
+
+def _format_daily_summary(payload: dict, symbol: str) -> str:
+    fmt_currency = _fmt_currency
+    orders  = payload.get("order_count", 0)
+    revenue = fmt_currency(payload.get("revenue", 0), symbol)
+    avg     = fmt_currency(payload.get("avg_order", 0), symbol)
+    date    = payload.get("date", "Today")
+    return _DAILY_SUMMARY_TMPL % (date, orders, revenue, avg)
+
+
+_EVENT_FORMATTERS = {
+    "low_stock":       _format_low_stock,
+    "contact_form":    _format_contact_form,
+    "maintenance_on":  _format_maintenance_on,
+    "maintenance_off": _format_maintenance_off,
+    "daily_summary":   _format_daily_summary,
+}
+
+
+def is_notifiable_event(event_type: str) -> bool:
+    """True if event_type produces a Telegram message — check before scheduling a send."""
+    return event_type in _EVENT_FORMATTERS
+
+
+# ======================
+# ORDER BATCHING
+# ======================
+# Orders are collected for ORDER_BATCH_WINDOW seconds and sent as one message
+# per chat, so a burst of orders doesn't hit Telegram's per-chat rate limit.
+
+ORDER_BATCH_WINDOW = 0.2
+ORDER_BATCH_MAX    = 20     # orders per message
+
+_order_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+
+async def run_order_batcher():
+    """Long-running task — start it once per process that sends order notifications."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _order_queue.get()]
+        try:
+            deadline = loop.time() + ORDER_BATCH_WINDOW
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(_order_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Shutting down — deliver what we have, plus anything still queued
+            while not _order_queue.empty():
+                batch.append(_order_queue.get_nowait())
+            await _deliver_order_batch(batch)
+            raise
+        await _deliver_order_batch(batch)
+
+
+async def _deliver_order_batch(batch: list):
+    # One bad batch must not end the batcher — later orders would pile up unsent
+    try:
+        await _send_order_batch(batch)
+    except Exception:
+        log.exception(f"Order batch of {len(batch)} failed")
+
+
+async def _send_order_batch(batch: list):
+    # Keyed by store as well as chat: one chat can be linked to several stores,
+    # each with its own currency and timezone, and their totals must not mix.
+    by_chat: dict[tuple[int, int], tuple[dict, list]] = {}
+    for client, order in batch:
+        key = (client["telegram_chat_id"], client["id"])
+        by_chat.setdefault(key, (client, []))[1].append(order)
+
+    jobs = []
+    for (chat_id, _), (client, orders) in by_chat.items():
+        for i in range(0, len(orders), ORDER_BATCH_MAX):
+            chunk = orders[i:i + ORDER_BATCH_MAX]
+            try:
+                text = _format_order(client, chunk[0]) if len(chunk) == 1 else _format_order_batch(client, chunk)
+            except Exception:
+                log.exception(f"Could not format {len(chunk)} order(s) for chat {chat_id}")
+                continue
+            jobs.append((chat_id, text))
+
+    for (chat_id, _), result in zip(jobs, await send_many(jobs)):
+        if isinstance(result, Exception):
+            log.error(f"Order notification failed for chat {chat_id}: {result}")
 
 
 # ======================
 # COMMAND REPLY FORMATTERS
 # ======================
 
+def _format_period(client: dict, stats: dict, title: str) -> str:
+    return _PERIOD_TMPL.format_map({"title": title, "symbol": client["_sym"], **stats})
+
 def format_today(client: dict, stats: dict) -> str:
-    symbol = client.get("currency_symbol", "$")
-    return (
-        f"📊 *Today*\n"
-        f"\n"
-        f"Orders: *{stats['order_count']}*\n"
-        f"Revenue: *{_fmt_currency(stats['revenue'], symbol)}*\n"
-        f"Avg order: *{_fmt_currency(stats['avg_order'], symbol)}*"
-    )
+    return _format_period(client, stats, "Today")
 
 def format_week(client: dict, stats: dict) -> str:
-    symbol = client.get("currency_symbol", "$")
-    return (
-        f"📊 *Last 7 Days*\n"
-        f"\n"
-        f"Orders: *{stats['order_count']}*\n"
-        f"Revenue: *{_fmt_currency(stats['revenue'], symbol)}*\n"
-        f"Avg order: *{_fmt_currency(stats['avg_order'], symbol)}*"
-    )
+    return _format_period(client, stats, "Last 7 Days")
 
 def format_month(client: dict, stats: dict) -> str:
-    symbol = client.get("currency_symbol", "$")
-    return (
-        f"📊 *Last 30 Days*\n"
-        f"\n"
-        f"Orders: *{stats['order_count']}*\n"
-        f"Revenue: *{_fmt_currency(stats['revenue'], symbol)}*\n"
-        f"Avg order: *{_fmt_currency(stats['avg_order'], symbol)}*"
-    )
+    return _format_period(client, stats, "Last 30 Days")
+
+_STATUS_ICON = {"pending": "⏳", "fulfilled": "✅", "cancelled": "❌"}
+
+@lru_cache(maxsize=64)
+def _make_row_fmt(symbol: str):
+    """One /orders row formatter per currency symbol, with the symbol bound in."""
+    icon = _STATUS_ICON.get
+    md   = _md
+    def fmt(o: dict) -> str:
+        return f"{icon(o['status'], '•')} #{md(o['order_number'])} · {md(o.get('customer_name') or _UNKNOWN)} · *{symbol}{o['total']:,.2f}*"
+    return fmt
 
 def format_recent_orders(client: dict, orders: list) -> str:
-    symbol = client.get("currency_symbol", "$")
     if not orders:
         return "No orders yet."
-    lines = ["🛒 *Recent Orders*\n"]
-    for o in orders:
-        name        = o.get("customer_name") or "Unknown"
-        total       = _fmt_currency(o["total"], symbol)
-        num         = o["order_number"]
-        status_icon = {"pending": "⏳", "fulfilled": "✅", "cancelled": "❌"}.get(o["status"], "•")
-        lines.append(f"{status_icon} #{num} · {name} · *{total}*")
-    return "\n".join(lines)
+    fmt = _make_row_fmt(client["_sym"])
+    return "🛒 *Recent Orders*\n\n" + "\n".join(map(fmt, orders))
@@ -7,14 +7,20 @@
 # Usage:
 #   python setup_client.py
 
+import re
 import secrets
 import database as db
+from config import SLUG_PATTERN
 
 def main():
     print("\n=== StorePing — New Client Setup ===\n")
+    db.init_db()
 
     name     = input("Store name (e.g. Turtle Island Jewelry): ").strip()
     slug     = input("Store slug (e.g. turtle-island, no spaces): ").strip().lower()
+    while not re.match(SLUG_PATTERN, slug):
+        print("Slugs are 2-63 characters: lowercase letters, digits and hyphens, not starting with a hyphen.")
+        slug = input("Store slug: ").strip().lower()
     timezone = input("Timezone (e.g. America/Toronto) [America/Toronto]: ").strip() or "America/Toronto"
     currency = input("Currency symbol (e.g. $, ₹, €) [$]: ").strip() or "$"
 